@@ -32,32 +32,49 @@
 
 from tree import RGBXmasTree
 from colorzero import Color, Hue
-from time import sleep
-from random import random
+from time import sleep, monotonic
 
 # LED number for star at the top of the tree
 STAR = 3
 LED_SET = [list(range(25)[::3]), list(range(25)[1::3]), list(range(25)[2::3])]
+# Hue advances 10 degrees per frame so the pattern repeats every 36 frames
+HUE_STEPS = 36
+# SPI writes per frame in the original per-LED loop (24 LEDs plus the star
+# off and on) which set the speed of the cycle and the length of the flash
+BASELINE_WRITES = 26
 
 # Create an instance of an RGBXmasTree
 tree = RGBXmasTree(brightness=0.1)
 colors = [Color('red'),Color('green'),Color('blue')]
-# Initialise the LEDs to starting colours
-for i, leds in enumerate(LED_SET):
-    for led in leds:
-        tree[led].color = colors[i]
-# Colour top LED white (will flash due to loop)
-tree[STAR].color = Color('white')
-# Main loop - hue phase in a slow cycle
+
+def buildFrame(step, star):
+    # Assemble a whole tree frame so it goes out in a single SPI write
+    frame = [None] * len(tree)
+    for i, leds in enumerate(LED_SET):
+        color = colors[i] + Hue(deg=10*step)
+        for led in leds:
+            frame[led] = color
+    frame[STAR] = star
+    return tuple(frame)
+
+# Precompute every frame of the hue cycle with the top LED lit and unlit
+# so the main loop does no colour maths
+frames = [(buildFrame(step, Color('white')), buildFrame(step, Color('black')))
+          for step in range(HUE_STEPS)]
+step = 0
+# Initialise the LEDs to starting colours with the top LED white, timing the
+# writes so the loop can keep the pace of the original one
+start = monotonic()
+tree.value = frames[step][1]
+tree.value = frames[step][0]
+frameDelay = (monotonic() - start) / 2 * (BASELINE_WRITES - 2)
+# Main loop - hue phase in a slow cycle with the top LED blinking off for one
+# write each frame as before
 try:
     while True:
-        for leds in LED_SET:
-            for led in leds:
-                tree[led].color += Hue(deg=10)
-        tree[STAR].color = Color('black')
-        #sleep(0.01)
-        tree[STAR].color = Color('white')
+        step = (step + 1) % HUE_STEPS
+        tree.value = frames[step][1]
+        tree.value = frames[step][0]
+        sleep(frameDelay)
 except KeyboardInterrupt:
     tree.close()
-
-
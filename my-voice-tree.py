@@ -23,7 +23,8 @@
 # Implementation:
 # --------------
 # Cooperative multitasking using Python asyncio to interleave between
-# micStream and RGBXmasTree LEDs.
+# micStream, Transcribe and Polly with the RGBXmasTree LEDs driven from
+# their own thread.
 #
 # History:
 # -------
@@ -38,42 +39,152 @@ import os
 import sys
 import vlc
 import time
+import signal
 import boto3
 import awscrt
 import asyncio
 import threading
+import hashlib
+import functools
+import collections
+import concurrent.futures
 import sounddevice
-from boto3 import Session
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
 from contextlib import closing
-from asyncio.subprocess import PIPE
+from dataclasses import dataclass
 from amazon_transcribe.client import TranscribeStreamingClient
 from amazon_transcribe.handlers import TranscriptResultStreamHandler
 from amazon_transcribe.model import TranscriptEvent
 from tree import RGBXmasTree
 from colorzero import Color, Hue
 from time import sleep
-from random import random
 
 # Create an instance of an RGBXmasTree
 TREE = RGBXmasTree(brightness=0.3)
 # LED number for star at the top of the tree
 STAR = 3
 TREE_LED_SET = [list(range(25)[::3]), list(range(25)[1::3]), list(range(25)[2::3])]
-LAST_STATE = 'disco'
-STATE = 'disco'
-TEXT = 'Hello everyone this is your Christmas Tree talking'
-AUDIO = ''
+# TREE_LED_SET flattened to the group index of each LED in tree order
+TREE_LED_GROUP = tuple(dict(sorted((led, group) for group, leds in enumerate(TREE_LED_SET)
+                                   for led in leds)).values())
+# Starting colour of each LED group in TREE_LED_SET and how far the groups
+# have since been rotated through the hue cycle
+GROUP_COLORS = [Color('red'),Color('green'),Color('blue')]
+HUE_STEP = 0
+# Hue advances 10 degrees per frame so the cycle repeats every 36 frames
+HUE_STEPS = 36
+# SPI writes per hue frame in the original per-LED loop (25 LEDs plus the
+# star) and the sleep after each, which set the speed of the hue cycle
+BASELINE_WRITES = 26
+BASELINE_SLEEP = 0.01
+# Set to stop the LED thread
+LED_STOP = threading.Event()
+# Core and SCHED_FIFO priority requested for the LED thread and for the
+# PortAudio thread running the mic callback, which must never miss a block
+LED_CPU = 3
+LED_PRIORITY = 10
+MIC_CPU = 2
+MIC_PRIORITY = 20
+# Set to wake the LED thread from a static frame when the state changes
+LED_WAKE = threading.Event()
+# Set to have the LED thread restart the disco pattern on its next frame
+LED_RESEED = threading.Event()
+# LED thread started by initializeVoiceTree
+LED_THREAD = None
 SUPPORTED_COLORS = ['red','green','blue','yellow','orange','purple',
                     'white','pink','black','brown','disco','phase']
+# States that cycle hue rather than showing one colour
+HUE_STATES = frozenset(['disco','phase'])
+# Parse each named colour once rather than on every frame
+COLOR_CACHE = {name: Color(name) for name in SUPPORTED_COLORS
+               if name not in HUE_STATES}
+# Hashed membership for the per-frame state tests in lightUpXmasTree
+SOLID_COLORS = frozenset(COLOR_CACHE)
+# Mic samples per sounddevice callback (64ms at 16kHz, inside Transcribe's
+# recommended 50-200ms chunk range) so each block is sent as one audio event
+MIC_BLOCKSIZE = 1024
+# Most mic blocks (~8s of audio) held while Transcribe is stalled before the
+# oldest are dropped
+MIC_BACKLOG = 128
+# Polly client shared by every utterance so its credentials, endpoint
+# metadata and HTTPS connection pool are set up once.  botocore's default 60s
+# timeouts would leave a 'generate' command hanging on a dead connection, so
+# fail fast on connect while still allowing time for a long phrase
+POLLY = boto3.Session(region_name='us-west-2').client('polly', config=Config(
+    connect_timeout=2, read_timeout=20, retries={'max_attempts': 2}))
+# Directory holding the bundled mp3 files, read once at start up
+WORKING_DIR = os.environ.get("WORKING_DIR") or '.'
+# Set DEBUG in the environment to echo every transcript Transcribe sends
+DEBUG = bool(os.environ.get("DEBUG"))
+POLLY_VOICE = 'Joanna'
+POLLY_ENGINE = 'neural'
+# Generated speech is cached by voice, engine and text so repeated phrases
+# skip Polly entirely.  The least recently used files go beyond the size limit
+POLLY_CACHE_DIR = os.path.expanduser('~/.cache/xmastree-polly')
+POLLY_CACHE_BYTES = 50*1024*1024
+# Worker threads for Polly requests and vlc playback so neither blocks the event loop
+AUDIO_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+# One vlc instance and player reused for every clip so the audio output is
+# only set up once.  PLAYER_DONE is set when the current clip ends or fails
+# and PLAYER_CLIP counts clips so a replaced clip's caller leaves the new one alone
+VLC = vlc.Instance('--intf=dummy', '--no-video')
+PLAYER = VLC.media_player_new()
+PLAYER_LOCK = threading.Lock()
+PLAYER_DONE = threading.Event()
+PLAYER_CLIP = 0
+PLAYER_EVENTS = PLAYER.event_manager()
+PLAYER_EVENTS.event_attach(vlc.EventType.MediaPlayerEndReached, lambda event: PLAYER_DONE.set())
+PLAYER_EVENTS.event_attach(vlc.EventType.MediaPlayerEncounteredError, lambda event: PLAYER_DONE.set())
+# Voice commands take the form "christmas tree <command> <optional text>"
+XMAS_TREE_PHRASE = 'christmas tree'
+# Whitespace then the command word that follow the phrase
+COMMAND_WORD_RE = re.compile(r'\s+(\w+)')
+# (result_id, is_partial, first transcript) of the last Transcribe result handled
+LAST_RESULT = None
+# States handled by waitForPolly and the event it waits on for them, created
+# per event loop since the retry loop in __main__ starts a fresh one each time
+AUDIO_STATES = ['speak','generate']
+AUDIO_REQUEST = None
+
+@dataclass
+class TreeState:
+    # Voice tree state shared by the Transcribe handler, Polly task and LED thread
+    state: str = 'disco'
+    last_state: str = 'disco'
+    text: str = 'Hello everyone this is your Christmas Tree talking'
+    audio: str = ''
+
+TREE_STATE = TreeState()
 
 async def micStream():
-    # Wraps raw input stream for mic forwarding blocks to asyncio.Queue
+    # Wraps raw input stream for mic forwarding blocks to the event loop via a deque
     loop = asyncio.get_event_loop()
-    input_queue = asyncio.Queue()
+    input_blocks = collections.deque(maxlen=MIC_BACKLOG)
+    input_ready = asyncio.Event()
+    firstCall = True
+    # Blocks discarded because the deque was full, reported from the event loop
+    dropped = 0
+    reported = 0
+    # Why the mic thread couldn't be pinned, also reported from the event loop
+    pinError = None
 
     def callback(indata, frame_count, time_info, status):
-        loop.call_soon_threadsafe(input_queue.put_nowait, (bytes(indata), status))
+        nonlocal firstCall, dropped, pinError
+        if firstCall:
+            # PortAudio creates this thread so it can only be pinned from here.
+            # Anything escaping the callback would abort the stream
+            firstCall = False
+            try:
+                pinError = pinThread(MIC_CPU, MIC_PRIORITY)
+            except Exception as e:
+                pinError = repr(e)
+        # Runs on the PortAudio thread so keep it to one copy and one append.
+        # A full deque discards its oldest block rather than growing
+        if len(input_blocks) == MIC_BACKLOG:
+            dropped += 1
+        input_blocks.append((bytes(indata), status))
+        loop.call_soon_threadsafe(input_ready.set)
 
     # audio stream params should mate the audio formats for the source language being used per:
     # https://docs.aws.amazon.com/transcribe/latest/dg/streaming.html
@@ -81,14 +192,22 @@ async def micStream():
         channels = 1,
         samplerate = 16000,
         callback = callback,
-        blocksize = 1024*2,
+        blocksize = MIC_BLOCKSIZE,
         dtype = "int16",
     )
     # Initiate the audio stream and async yield the audio chunks when they become available
     with stream:
         while True:
-            indata, status = await input_queue.get()
-            yield indata, status
+            await input_ready.wait()
+            input_ready.clear()
+            if pinError:
+                print(f"Mic thread using default scheduling: {pinError}")
+                pinError = None
+            if dropped != reported:
+                print(f"micStream: dropped {dropped - reported} blocks while Transcribe was behind")
+                reported = dropped
+            while input_blocks:
+                yield input_blocks.popleft()
 
 async def writeChunks(stream):
     print("writeChunks: ENTER")
@@ -102,204 +221,396 @@ class TranscribeEventHandler(TranscriptResultStreamHandler):
     async def handle_transcript_event(self, transcript_event: TranscriptEvent):
         #print("TranscribeEventHandler: ENTER")
         # Handle text transcriptions
-        xmasTree = re.compile(r'(christmas tree)(\.|\,|s)?\s+(\w+)(.*)')
+        global LAST_RESULT
         results = transcript_event.transcript.results
         for result in results:
+            # Transcribe resends the same partial result while it waits for more
+            # audio so skip anything identical to the result we last processed
+            first = result.alternatives[0].transcript if result.alternatives else None
+            seen = (result.result_id, result.is_partial, first)
+            if seen == LAST_RESULT:
+                continue
+            LAST_RESULT = seen
             for i,alt in enumerate(result.alternatives):
-                global STATE, LAST_STATE, TEXT, AUDIO
                 text = alt.transcript.lower()
-                print(f"{i}:'{alt.transcript}' ({text})")
-                xres = re.match(xmasTree,text)
-                def switchState(new_state):
-                    global STATE, LAST_STATE
-                    if STATE == new_state:
-                        print(f"We are already in STATE {STATE} - skipping")
-                    else:
-                        LAST_STATE = STATE
-                        STATE = new_state
-                        print(f"STATE CHANGE: '{new_state}' LAST_STATE={LAST_STATE}")
-                if xres:
-                    print(f"MATCH! xres[0]='{xres[0]}',xres[1]='{xres[1]}',\
-                            xres[2]='{xres[2]}',xres[3]='{xres[3]}',xres[4]='{xres[4]}'")
-                    command = xres[3].lower()
-                    if command in SUPPORTED_COLORS:
-                        switchState(command)
-                        if STATE in ['disco']:
-                            initXmasTree(darkMode=False)
-                        break
-                    elif command in ['speak','talk','talked']:
-                        AUDIO = 'speech.mp3'
-                        switchState('speak')
-                        break
-                    elif command in ['sing','saying','black mirror']:
-                        AUDIO = '08-I-Wish-it-Could-be-Christmas-Everyday.mp3'
-                        switchState('speak')
-                        break
-                    elif command == 'generate':
-                        TEXT = xres[4].replace('.','')
-                        if len(TEXT.strip()) >= 10:
-                            #TEXT = "You didn't give me anything to generate"
-                            switchState('generate')
-                            break
-                    else:
+                if DEBUG:
+                    print(f"{i}:'{alt.transcript}' ({text})")
+                parsed = parseCommand(text)
+                if parsed:
+                    command, rest = parsed
+                    print(f"MATCH! command='{command}',rest='{rest}'")
+                    action = COMMANDS.get(command)
+                    if action is None:
                         print(f"Cannot handle '{command}'")
+                    elif result.is_partial and command in FINAL_COMMANDS:
+                        # Single word commands act on partial results for speed
+                        # but free text is only complete in the final result
+                        continue
+                    elif action(command, rest):
+                        break
         #print("TranscribeEventHandler: EXIT")
 
-def initXmasTree(darkMode):
-    print(f"initXmasTree(darkMode={darkMode})")
-    global TREE, STATE
-    if darkMode:
-        STATE = 'black'
-        for i, leds in enumerate(TREE_LED_SET):
-            for led in leds:
-                TREE[led].color = Color('black')
-        # Colour top LED white
-        TREE[STAR].color = Color('black')
+def parseCommand(text):
+    # Splits "christmas tree <command> <rest>" into (command, rest), or returns
+    # None if text isn't a command.  The phrase is checked with startswith so
+    # ordinary speech never reaches the regex
+    if not text.startswith(XMAS_TREE_PHRASE):
+        return None
+    rest = text[len(XMAS_TREE_PHRASE):]
+    # Transcribe often punctuates or pluralises the phrase
+    if rest[:1] in ('.', ',', 's'):
+        rest = rest[1:]
+    words = COMMAND_WORD_RE.match(rest)
+    if not words:
+        return None
+    return words[1], rest[words.end():]
+
+def switchState(new_state):
+    ts = TREE_STATE
+    if ts.state == new_state:
+        print(f"We are already in STATE {ts.state} - skipping")
     else:
-        assert(STATE in ['disco'])
-        # Initialise the LEDs to starting colours
-        colors = [Color('red'),Color('green'),Color('blue')]
-        for i, leds in enumerate(TREE_LED_SET):
-            for led in leds:
-                TREE[led].color = colors[i]
-        # Colour top LED white
-        TREE[STAR].color = Color('white')
-
-async def lightUpXmasTree():
+        ts.last_state = ts.state
+        ts.state = new_state
+        print(f"STATE CHANGE: '{new_state}' LAST_STATE={ts.last_state}")
+        LED_WAKE.set()
+        if new_state in AUDIO_STATES and AUDIO_REQUEST:
+            AUDIO_REQUEST.set()
+
+def colorCommand(command, rest):
+    if command == 'disco':
+        # Restart the pattern from red, green and blue.  The LED thread does
+        # the reset itself since it owns GROUP_COLORS and HUE_STEP
+        LED_RESEED.set()
+    switchState(command)
+    return True
+
+def speakCommand(command, rest):
+    TREE_STATE.audio = 'speech.mp3'
+    switchState('speak')
+    return True
+
+def singCommand(command, rest):
+    TREE_STATE.audio = '08-I-Wish-it-Could-be-Christmas-Everyday.mp3'
+    switchState('speak')
+    return True
+
+def generateCommand(command, rest):
+    TREE_STATE.text = rest.replace('.','')
+    if len(TREE_STATE.text.strip()) >= 10:
+        #TEXT = "You didn't give me anything to generate"
+        switchState('generate')
+        return True
+    return False
+
+# Commands followed by free text, which must wait for the final transcript
+FINAL_COMMANDS = frozenset(['generate'])
+
+# Action for each word that can follow "christmas tree".  Actions return
+# True once the command has been handled
+COMMANDS = {color: colorCommand for color in SUPPORTED_COLORS}
+COMMANDS.update({'speak': speakCommand, 'talk': speakCommand, 'talked': speakCommand,
+                 'sing': singCommand, 'saying': singCommand,
+                 'generate': generateCommand})
+
+@functools.lru_cache(maxsize=None)
+def hueCycle(color):
+    # Precomputed hue rotations of color so frames need no colour maths
+    return tuple(color + Hue(deg=10*step) for step in range(HUE_STEPS))
+
+def showXmasTree(star=None):
+    # Assemble the whole frame and write it to the tree in a single SPI transfer
+    colors = [hueCycle(color)[HUE_STEP] for color in GROUP_COLORS]
+    frame = [colors[group] for group in TREE_LED_GROUP]
+    if star is not None:
+        frame[STAR] = star
+    TREE.value = tuple(frame)
+
+def initXmasTree():
+    # Only resets the pattern - the LED thread draws it on its next frame.
+    # Must run on the LED thread, which is the only writer of the pattern
+    print("initXmasTree()")
+    global HUE_STEP
+    HUE_STEP = 0
+    # Initialise the LEDs to starting colours
+    GROUP_COLORS[:] = [COLOR_CACHE['red'],COLOR_CACHE['green'],COLOR_CACHE['blue']]
+
+def pinThread(cpu, priority):
+    # Best effort: keep the calling thread on its own core at real-time
+    # priority.  Linux only and SCHED_FIFO needs root or
+    # sudo setcap cap_sys_nice+ep $(which python3).  Returns why the thread
+    # kept default scheduling, or None
+    try:
+        if cpu < (os.cpu_count() or 0):
+            os.sched_setaffinity(0, {cpu})
+        # Leave a thread that is already real-time, like PortAudio's under ALSA,
+        # with the scheduling it was given
+        if os.sched_getscheduler(0) == os.SCHED_OTHER:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (AttributeError, OSError) as e:
+        return str(e)
+    return None
+
+def lightUpXmasTree():
+    # Runs on its own thread so LED frames never hold up the event loop
     print("lightUpXmasTree: ENTER")
-    initXmasTree(darkMode=False)
+    pinError = pinThread(LED_CPU, LED_PRIORITY)
+    if pinError:
+        print(f"LED thread using default scheduling: {pinError}")
+    global HUE_STEP
+    ts = TREE_STATE
+    # Bind everything the frame loop touches to locals once up front
+    white = COLOR_CACHE['white']
+    colors = COLOR_CACHE
+    groups = GROUP_COLORS
+    groupCount = len(groups)
+    hueStates = HUE_STATES
+    solidColors = SOLID_COLORS
+    show = showXmasTree
+    stopped = LED_STOP.is_set
+    wait = LED_STOP.wait
+    woken = LED_WAKE
+    reseed = LED_RESEED
+    # Seed the first frame through the same path as a 'disco' command.  A retry
+    # after a dropped connection keeps whatever state was last asked for
+    reseed.set()
+    clock = time.monotonic
+    # Frames are scheduled against an absolute deadline so the time spent
+    # drawing doesn't add to the gap between them
+    nextFrame = clock()
+    # Seconds between hue frames, set from the time the first one takes
+    frameDelay = None
     try:
-        global TREE, TREE_LED_SET, SUPPORTED_COLORS, STATE, LAST_STATE
-        while True:
-            #print(f'XmasTree: {STATE} ({LAST_STATE})')
-            if (STATE in ['disco','phase']):
+        while not stopped():
+            # Clear before reading the state so a change can't be missed
+            woken.clear()
+            # Read the state once per frame - only the event loop writes it
+            state = ts.state
+            #print(f'XmasTree: {state} ({ts.last_state})')
+            if reseed.is_set():
+                reseed.clear()
+                if state == 'disco':
+                    initXmasTree()
+            if state in hueStates:
                 # Hue phase in a slow cycle through all colors
-                for leds in TREE_LED_SET:
-                    for led in leds:
-                        TREE[led].color += Hue(deg=10)
-                TREE[STAR].color = Color('white')
-                LAST_STATE = STATE
-            elif STATE in SUPPORTED_COLORS:
+                HUE_STEP = (HUE_STEP + 1) % HUE_STEPS
+                if frameDelay is None:
+                    # Time one write to pace the cycle like the original loop
+                    start = clock()
+                    show(star=white)
+                    frameDelay = (clock() - start) * (BASELINE_WRITES - 1) + BASELINE_SLEEP
+                else:
+                    show(star=white)
+            elif state in solidColors:
                 # Solid color
-                for leds in TREE_LED_SET:
-                    for led in leds:
-                        TREE[led].color = Color(STATE)
-                if STATE not in ['black']:
-                    TREE[STAR].color = Color('white')
-                LAST_STATE = STATE
+                groups[:] = [colors[state]] * groupCount
+                HUE_STEP = 0
+                if state != 'black':
+                    show(star=white)
+                else:
+                    show()
             else:
-                # print(f"Skipping unknown state {STATE}')
+                # print(f"Skipping unknown state {state}')
                 pass
-            await asyncio.sleep(0.01) # non-blocking
-    except:
-        print("Exiting tree")
-        TREE.close()
+            if state not in hueStates:
+                # Nothing moves outside the hue cycle so sleep until the
+                # state changes or we are stopped
+                woken.wait()
+                nextFrame = clock()
+                continue
+            nextFrame += frameDelay
+            delay = nextFrame - clock()
+            if delay > 0:
+                wait(delay)
+            else:
+                # Running behind so start again from now rather than rushing
+                nextFrame = clock()
+    except Exception as e:
+        print(f"Exiting tree: {e}")
     print("lightUpXmasTree: EXIT")
-    raise KeyboardInterrupt
 
-def playMp3(file,length):
+def stopXmasTree():
+    # Wait for the LED thread to finish its frame so nothing writes to the
+    # tree once this returns
+    LED_STOP.set()
+    LED_WAKE.set()
+    if LED_THREAD:
+        LED_THREAD.join()
+
+@functools.lru_cache(maxsize=2)
+def loadMedia(file):
+    # vlc only parses a clip once, so keep its Media for the next time it is
+    # played.  Only used for the two bundled clips
+    return VLC.media_new(file)
+
+def playMp3(file,length=None):
+    global PLAYER_CLIP
     print(f"playMp3({file})")
-    player = vlc.MediaPlayer(file)
-    player.play()
-    time.sleep(length)
-    player.stop()
+    # A new clip replaces whatever is already playing
+    with PLAYER_LOCK:
+        PLAYER.stop()
+        # Wake the caller of a replaced clip before waiting on the new one
+        PLAYER_DONE.set()
+        PLAYER_DONE.clear()
+        # Polly phrases are loaded fresh so their Media isn't held for the
+        # life of the process
+        if file.startswith(POLLY_CACHE_DIR):
+            PLAYER.set_media(VLC.media_new(file))
+        else:
+            PLAYER.set_media(loadMedia(file))
+        PLAYER.play()
+        PLAYER_CLIP += 1
+        clip = PLAYER_CLIP
+    # Return as soon as vlc finishes (or fails) rather than sleeping for a
+    # fixed time.  length optionally caps how long to play for
+    PLAYER_DONE.wait(timeout=length)
+    with PLAYER_LOCK:
+        if clip == PLAYER_CLIP:
+            PLAYER.stop()
+
+def logAudioFailure(future):
+    # Done callback for audio pool work nothing awaits, so failures are printed
+    # instead of being lost with the future
+    if not future.cancelled() and future.exception():
+        print(f"Audio task failed: {future.exception()!r}")
+
+def stopAudio():
+    # Cut off the current clip so its worker returns instead of waiting for the
+    # song to end, then drop any queued Polly or playback work.  Doesn't wait
+    # for an in-flight Polly request so the tree is shut down straight away;
+    # the pool's threads aren't daemons so exit still waits for it, within the
+    # POLLY client's connect and read timeouts
+    with PLAYER_LOCK:
+        PLAYER.stop()
+        PLAYER_DONE.set()
+    AUDIO_POOL.shutdown(wait=False, cancel_futures=True)
 
 def generateMp3WithPolly(text, file):
     """ From AWS Getting Started Example """
     print(f"Generating polly file {file} from: '{text}'")
-    polly_client = boto3.Session(region_name='us-west-2').client('polly')
-    response = polly_client.synthesize_speech(VoiceId='Joanna',
+    response = POLLY.synthesize_speech(VoiceId=POLLY_VOICE,
                 OutputFormat='mp3', 
                 Text = text,
-                Engine = 'neural')
-    file = open(file, 'wb')
-    file.write(response['AudioStream'].read())
-    file.close()
+                Engine = POLLY_ENGINE)
+    with closing(response['AudioStream']) as stream, open(file, 'wb') as f:
+        f.write(stream.read())
+
+def cachedMp3WithPolly(text):
+    # Returns an mp3 of text from the cache, only calling Polly on a miss
+    text = text.strip()
+    key = hashlib.sha256(f'{POLLY_ENGINE}|{POLLY_VOICE}|{text}'.encode()).hexdigest()
+    file = os.path.join(POLLY_CACHE_DIR, f'{key}.mp3')
+    if os.path.isfile(file) and os.path.getsize(file) > 0:
+        print(f"Using cached polly file {file}")
+        # Mark as recently used since atime is often not updated on a Pi
+        os.utime(file)
+        return file
+    os.makedirs(POLLY_CACHE_DIR, exist_ok=True)
+    # Write under a temporary name so a failed request never leaves a bad
+    # entry, and remove the partial file so it can't leak outside the size limit
+    partial = f'{file}.part'
+    try:
+        generateMp3WithPolly(text, partial)
+    except BaseException:
+        try:
+            os.remove(partial)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(partial, file)
+    return file
+
+def trimPollyCache():
+    # Remove least recently used files until the cache fits POLLY_CACHE_BYTES
+    entries = []
+    for entry in os.scandir(POLLY_CACHE_DIR):
+        if entry.name.endswith('.mp3'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= POLLY_CACHE_BYTES:
+            break
+        os.remove(path)
+        total -= size
     
 async def waitForPolly():
+    global AUDIO_REQUEST
     print("waitForPolly: ENTER")
-    global TEXT, STATE, LAST_STATE, AUDIO
+    ts = TREE_STATE
+    loop = asyncio.get_running_loop()
+    AUDIO_REQUEST = asyncio.Event()
+    if ts.state in AUDIO_STATES:
+        AUDIO_REQUEST.set()
     while True:
-        await asyncio.sleep(0.1)
-        #print(f"polly state: {STATE}")
-        if STATE == 'speak':
-            # Initially tried this using asyncio.create_subprocess_exec using a local script
-            """
-            speechFile = 'speech2.mp3'
-            process = await asyncio.create_subprocess_exec(
-                'python',
-                'testVlc.py',
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            process = await asyncio.create_subprocess_shell(
-                f'python testVlc.py',
-                stdout=PIPE,
-                stderr=PIPE,
-            )
-            print("going into process communicate")
-            (output,err) = await process.communicate()
-            status = await process.wait()
-            print(f"dropping out of await. STATE={STATE}, LAST_STATE={LAST_STATE}")
-            """
-            cwd = os.environ.get("WORKING_DIR")
-            if not cwd:
-                cwd = '.'
-            speechFile = f'{cwd}/{AUDIO}'
-            length = 360
-            if AUDIO == 'speech.mp3':
-                length = 10
+        # Sleep until switchState asks for speech rather than polling
+        await AUDIO_REQUEST.wait()
+        AUDIO_REQUEST.clear()
+        #print(f"polly state: {ts.state}")
+        if ts.state == 'speak':
+            speechFile = f'{WORKING_DIR}/{ts.audio}'
             print(f"Using vlc to play {speechFile} - non-blocking")
-            # Switched to using threads to avoid blocking
-            x2 = threading.Thread(target=playMp3, args=(speechFile,length), daemon=False)
-            x2.start()
-            #x2.join() # uncomment this to block on completion
-            print(f"dropping out after starting vlc thread. STATE={STATE}, LAST_STATE={LAST_STATE}")
-            STATE = LAST_STATE
-            LAST_STATE = 'speak'
-            print(f"Switching back to {STATE}")
-        elif STATE == 'generate':
-            cwd = os.environ.get("WORKING_DIR")
-            if not cwd:
-                cwd = '.'
-            speechFile = f'{cwd}/generate.mp3'
-            print(f"Generating speech file {speechFile} - blocking")
-            x1 = threading.Thread(target=generateMp3WithPolly, args=(TEXT,speechFile,), daemon=False)
-            x1.start()
-            x1.join() # uncomment this to block on completion
-            print(f"Using vlc to play {speechFile} - non-blocking")
-            # Switched to using threads to avoid blocking
-            x2 = threading.Thread(target=playMp3, args=(speechFile,), daemon=False)
-            x2.start()
-            #x2.join() # uncomment this to block on completion
-            print(f"dropping out after starting vlc thread. STATE={STATE}, LAST_STATE={LAST_STATE}")
-            STATE = LAST_STATE
-            LAST_STATE = 'speak'
-            print(f"Switching back to {STATE}")
-
-
-def synthesizeText(text):
-    polly_client = boto3.Session(region_name='us-west-2').client('polly')
-    response = polly_client.synthesize_speech(VoiceId='Joanna',
-                                              OutputFormat='mp3', 
-                                              Text = 'This is a sample text to be synthesized.',
-                                              Engine = 'neural')
-    with open('speech.mp3', 'wb'):
-        file.write(response['AudioStream'].read())
-
-            
+            # Play on the audio pool to avoid blocking
+            loop.run_in_executor(AUDIO_POOL, playMp3, speechFile).add_done_callback(logAudioFailure)
+            print(f"dropping out after starting vlc playback. STATE={ts.state}, LAST_STATE={ts.last_state}")
+            ts.state = ts.last_state
+            ts.last_state = 'speak'
+            LED_WAKE.set()
+            print(f"Switching back to {ts.state}")
+        elif ts.state == 'generate':
+            print(f"Generating speech for '{ts.text}' - non-blocking")
+            previous = ts.last_state
+            try:
+                speechFile = await loop.run_in_executor(AUDIO_POOL, cachedMp3WithPolly, ts.text)
+            except (BotoCoreError, ClientError, OSError) as e:
+                # A failed phrase shouldn't tear down the Transcribe session
+                print(f"Polly could not generate speech: {e}")
+            else:
+                print(f"Using vlc to play {speechFile} - non-blocking")
+                loop.run_in_executor(AUDIO_POOL, playMp3, speechFile).add_done_callback(logAudioFailure)
+                # Queued behind playback so trimming the cache never delays it
+                loop.run_in_executor(AUDIO_POOL, trimPollyCache).add_done_callback(logAudioFailure)
+                print(f"dropping out after starting vlc playback. STATE={ts.state}, LAST_STATE={ts.last_state}")
+            # Commands keep arriving while Polly runs so only switch back if
+            # nothing else has changed the state, and never back to 'generate'
+            if ts.state == 'generate':
+                ts.state = previous
+                ts.last_state = 'speak'
+                LED_WAKE.set()
+            elif ts.last_state == 'generate':
+                ts.last_state = previous
+            print(f"Switching back to {ts.state}")
+
+
 async def initializeVoiceTree():
-    # setup client with chosen AWS region
-    client = TranscribeStreamingClient(region = "us-west-2")
-    # start transcription to generate our async mic stream
-    stream = await client.start_stream_transcription(
-        language_code = "en-US",
-        media_sample_rate_hz = 16000,
-        media_encoding = "pcm",
-    )
-    handler = TranscribeEventHandler(stream.output_stream)
-    await asyncio.gather(writeChunks(stream), handler.handle_events(), lightUpXmasTree(), waitForPolly())
-    #await asyncio.gather(writeChunks(stream), handler.handle_events(), lightUpXmasTree())
+    # Light the tree first so it isn't dark while Transcribe connects
+    global LED_THREAD
+    LED_STOP.clear()
+    LED_THREAD = threading.Thread(target=lightUpXmasTree, daemon=True)
+    LED_THREAD.start()
+    try:
+        # setup client with chosen AWS region
+        client = TranscribeStreamingClient(region = "us-west-2")
+        # start transcription to generate our async mic stream
+        stream = await client.start_stream_transcription(
+            language_code = "en-US",
+            media_sample_rate_hz = 16000,
+            media_encoding = "pcm",
+        )
+        handler = TranscribeEventHandler(stream.output_stream)
+        tasks = [asyncio.create_task(writeChunks(stream)),
+                 asyncio.create_task(handler.handle_events()),
+                 asyncio.create_task(waitForPolly())]
+        # Stop everything as soon as one task fails so the retry loop in
+        # __main__ starts over instead of leaving the others running
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            task.result()
+    finally:
+        stopXmasTree()
 
 if __name__ == '__main__':
     def initialiseLoop():
@@ -323,11 +634,20 @@ if __name__ == '__main__':
             ret = -1
         return ret
 
-    while True:
-        r = initialiseLoop()
-        if r == 0:
-            sys.exit(0)
-        else:
+    # Treat SIGTERM (e.g. systemctl stop) like Ctrl-C so it takes the same
+    # clean shutdown path instead of killing the process mid-frame
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while initialiseLoop() != 0:
             retry = 2
             print(f'Retrying after {retry} secs..')
             sleep(retry)
+    except KeyboardInterrupt:
+        # Interrupted between retries, e.g. while DNS is still failing at boot
+        print('Exiting main loop')
+    # Stop playback and the audio workers first so exit doesn't wait
+    # on a song, then the LED thread before the tree it drives
+    stopAudio()
+    stopXmasTree()
+    TREE.close()
+    sys.exit(0)
@@ -10,65 +10,6 @@ from time import sleep
 
 Device.pin_factory = RPiGPIOFactory()
 
-class Pixel:
-    def __init__(self, parent, index):
-        self.parent = parent
-        self.index = index
-
-    @property
-    def value(self):
-        return self.parent.value[self.index]
-
-    @value.setter
-    def value(self, value):
-        new_parent_value = list(self.parent.value)
-        new_parent_value[self.index] = value
-        self.parent.value = tuple(new_parent_value)
-
-    @property
-    def color(self):
-        return Color(*self.value)
-
-    @color.setter
-    def color(self, c):
-        r, g, b = c
-        self.value = (r, g, b)
-
-    def on(self):
-        self.value = (1, 1, 1)
-
-class Pixel:
-    def __init__(self, parent, index):
-        self.parent = parent
-        self.index = index
-
-    @property
-    def value(self):
-        return self.parent.value[self.index]
-
-    @value.setter
-    def value(self, value):
-        new_parent_value = list(self.parent.value)
-        new_parent_value[self.index] = value
-        self.parent.value = tuple(new_parent_value)
-
-    @property
-    def color(self):
-        return Color(*self.value)
-
-    @color.setter
-    def color(self, c):
-        r, g, b = c
-        self.value = (r, g, b)
-
-    def on(self):
-        self.value = (1, 1, 1)
-
-from gpiozero import SPIDevice, SourceMixin
-from colorzero import Color, Hue
-from statistics import mean
-from time import sleep
-
 
 class Pixel:
     def __init__(self, parent, index):
@@ -106,6 +47,7 @@ class RGBXmasTree(SourceMixin, SPIDevice):
         super(RGBXmasTree, self).__init__(mosi_pin=mosi_pin, clock_pin=clock_pin, *args, **kwargs)
         self._all = [Pixel(parent=self, index=i) for i in range(pixels)]
         self._value = [(0, 0, 0)] * pixels
+        self._frame = None
         self.brightness = brightness
         self.off()
 
@@ -147,16 +89,21 @@ class RGBXmasTree(SourceMixin, SPIDevice):
 
     @value.setter
     def value(self, value):
-        start_of_frame = [0]*4
-        end_of_frame = [0]*5
+        value = tuple(value)
+        # The LEDs latch the last frame so skip the (bit-banged) SPI
+        # transfer when neither the pixels nor the brightness have changed
+        frame = (value, self._brightness_bits)
+        if frame == self._frame:
+            return
                      # SSSBBBBB (start, brightness)
         brightness = 0b11100000 | self._brightness_bits
-        pixels = [[int(255*v) for v in p] for p in value]
-        pixels = [[brightness, b, g, r] for r, g, b in pixels]
-        pixels = [i for p in pixels for i in p]
-        data = start_of_frame + pixels + end_of_frame
+        data = [0]*4
+        for r, g, b in value:
+            data += (brightness, int(255*b), int(255*g), int(255*r))
+        data += [0]*5
         self._spi.transfer(data)
         self._value = value
+        self._frame = frame
 
     def on(self):
         self.value = ((1, 1, 1),) * len(self)